@@ -10,8 +10,20 @@
 # In[1]:
 
 
+import atexit
+import functools
+import queue
 import random
+import threading
+import numpy as np
 from matplotlib import pyplot as plt
+from matplotlib.figure import Figure
+
+try:
+    from numba_kernels import batch_evolve_into, evolve_into
+except ImportError:
+    # Numba isn't available; the pure-NumPy kernels defined below are used instead
+    batch_evolve_into = evolve_into = None
 
 
 # ## Spaghetti code implementation of 3-state cellular automata (no functions or classes)
@@ -28,9 +40,6 @@ initial_condition = []
 for i in range(length):
     initial_condition.append(random.randint(0,2))
 
-# create list of neighborhood tuples in lex. order
-neighborhoods = [(0,0), (0,1), (0,2), (1,0), (1,1), (1,2), (2,0), (2,1), (2,2)]
-
 # convert the rule number to ternary and pad with 0s as needed
 tern_nums = []
 while rule_number > 0:
@@ -43,29 +52,28 @@ if ternary_length != 9:
     padding = 9 - ternary_length
     in_ternary = in_ternary + '0'*padding
 
-# create the lookup table dictionary
-lookup_table = {}
-for i in range(9):
-    key = neighborhoods[i]
-    val = in_ternary[i]
-    lookup_table.update({key:val})
+# create the lookup table as a list of ints, where entry 3*a + b is the output for the
+# neighborhood (a, b); neighborhoods are in lex. order, so this is just the ternary digits
+lookup_table = [int(digit) for digit in in_ternary]
     
-# initialize spacetime field and current configuration
+# initialize spacetime field, and two configuration buffers that are swapped every time step
 spacetime_field = [initial_condition]
 current_configuration = initial_condition.copy()
+new_configuration = [0]*length
 
 # apply the lookup table to evolve the CA for the given number of time steps
 for t in range(time):
-    new_configuration = []
-    for i in range(len(current_configuration)):
+    # carry the cell above and to the left, starting from the wrap-around cell at the far end
+    left = current_configuration[-1]
+    for i in range(length):
         
-        neighborhood = (current_configuration[(i-1)], 
-                        current_configuration[i])
+        neighborhood = left*3 + current_configuration[i]
         
-        new_configuration.append(int(lookup_table[neighborhood]))
+        new_configuration[i] = lookup_table[neighborhood]
+        left = current_configuration[i]
         
-    current_configuration = new_configuration
-    spacetime_field.append(new_configuration)
+    current_configuration, new_configuration = new_configuration, current_configuration
+    spacetime_field.append(current_configuration[:])
     
 # plot the spacetime field diagram
 plt.figure(figsize=(12,12))
@@ -78,7 +86,7 @@ plt.show()
 # In[4]:
 
 
-def random_ternary_string(length):
+def random_ternary_string(length, rng=None):
     '''
     Returns a random ternary string of the given length. 
     
@@ -86,15 +94,20 @@ def random_ternary_string(length):
     ----------
     length: int
         Posivite integer that specifies the desired length of the ternary string.
+    rng: numpy.random.Generator, optional (default=None)
+        Random number generator to draw from, e.g. np.random.default_rng(seed) for reproducible
+        strings. If None, a fresh default generator is used.
         
     Returns
     -------
-    out: list
-        The random ternary string given as a list, with int elements.
+    out: ndarray
+        The random ternary string given as a uint8 array.
     '''
     if not isinstance(length, int) or length < 0:
         raise ValueError("input length must be a positive ingeter")
-    return [random.randint(0,2) for _ in range(length)]
+    if rng is None:
+        rng = np.random.default_rng()
+    return rng.integers(0, 3, size=length, dtype=np.uint8)
 
 
 # In[5]:
@@ -117,22 +130,121 @@ def three_state_lookup_table(rule_number):
         Lookup table dictionary that maps neighborhood tuples to their output according to the 
         ECA local evolution rule (i.e. the lookup table), as specified by the rule number. 
     '''
-    if not isinstance(rule_number, int) or rule_number < 0 or rule_number > 19682:
-        raise ValueError("rule_number must be an int between 0 and 19682, inclusive")
+    lut = three_state_lookup_array(rule_number)
     neighborhoods = [(0,0), (0,1), (0,2), (1,0), (1,1), (1,2), (2,0), (2,1), (2,2)]
+    return dict(zip(neighborhoods, map(int,lut))) # use map so that outputs are ints, not numpy scalars
+
+
+# In[ ]:
+
+
+@functools.cache
+def all_lookup_arrays():
+    '''
+    Returns the flat lookup tables of all 19683 three-state CA rules, decoded in bulk the
+    first time this is called.
     
-    tern_nums = []
-    while rule_number > 0:
-        rule_number, r = divmod(rule_number,3)
-        tern_nums.append(str(r))
-    tern_num = ''.join(reversed(tern_nums))
-    
-    in_ternary = '{:{fill}{align}{width}}'.format(tern_num, 
-                                                  fill='0', 
-                                                  align='>', 
-                                                  width='9')
+    Returns
+    -------
+    luts: ndarray
+        Read-only uint8 array of shape (19683, 9); luts[rule_number] is the lookup array
+        returned by three_state_lookup_array(rule_number).
+    '''
+    luts = np.empty((19683, 9), dtype=np.uint8)
+    r = np.arange(19683)
+    # peel off the ternary digits of every rule number at once, least significant first
+    for i in range(9):
+        luts[:, i] = r % 3
+        r //= 3
+    luts.flags.writeable = False
+    return luts
+
+
+def three_state_lookup_array(rule_number):
+    '''
+    Returns the three-state CA lookup table as a flat array, indexed by the packed neighborhood
+    3*a + b for the neighborhood tuple (a, b). Uses Wolfram rule number convention.
     
-    return dict(zip(neighborhoods, map(int,reversed(in_ternary)))) # use map so that outputs are ints, not strings
+    Parameters
+    ----------
+    rule_number: int
+        Integer value between 0 and 19682, inclusive. Specifies the CA lookup table
+        according to the Wolfram numbering scheme.
+        
+    Returns
+    -------
+    lut: ndarray
+        Read-only length-9 uint8 array with lut[3*a + b] equal to the output for neighborhood
+        (a, b). This is a view of the corresponding row of all_lookup_arrays().
+    '''
+    if not isinstance(rule_number, int) or rule_number < 0 or rule_number > 19682:
+        raise ValueError("rule_number must be an int between 0 and 19682, inclusive")
+    return all_lookup_arrays()[rule_number]
+
+
+# In[ ]:
+
+
+def _validate_ic(initial_condition, ndim=1):
+    '''
+    Checks that the given initial condition only contains 0s, 1s and 2s and has ndim dimensions
+    (1 for a single CA, 2 for a batch of them), and returns it as a uint8 array ready for the
+    evolution kernels.
+    '''
+    if ndim == 1:
+        message = "initial condition must be a list of 0s, 1s and 2s"
+    else:
+        message = "initial conditions must be a %dD array of 0s, 1s and 2s" % ndim
+    try:
+        initial_condition = np.asarray(initial_condition)
+    except ValueError: # ragged nested lists
+        raise ValueError(message)
+    if ndim == 2 and initial_condition.shape == (0,):
+        # an empty list has no rows to take the lattice length from; treat it as a (0, 0) batch
+        initial_condition = initial_condition.reshape(0, 0)
+    if initial_condition.ndim != ndim or not np.isin(initial_condition, (0,1,2)).all():
+        raise ValueError(message)
+    return initial_condition.astype(np.uint8)
+
+
+# In[ ]:
+
+
+def numpy_evolve_into(out, lut, nthreads=None):
+    '''
+    Pure-NumPy counterpart of numba_kernels.evolve_into: evolves out[0] in place to fill the
+    remaining rows of out, with one vectorized update per time step. nthreads is accepted
+    for compatibility and ignored.
+    '''
+    if out.shape[1] == 0:
+        return
+    # scratch index buffer reused across time steps. It is intp, the index type take works
+    # with, so take doesn't convert it into a temporary on every step
+    neighborhood = np.empty(out.shape[1], dtype=np.intp)
+    for t in range(out.shape[0]-1):
+        prev = out[t]
+        # shift the cell above and to the left into line with each cell (wrapping around), then
+        # pack the two cells of each neighborhood in base 3 as the lookup index 3*a + b
+        neighborhood[0] = prev[-1]
+        neighborhood[1:] = prev[:-1]
+        np.multiply(neighborhood, 3, out=neighborhood)
+        np.add(neighborhood, prev, out=neighborhood)
+        # the indices are always between 0 and 8, so mode='clip' never changes them; unlike the
+        # default mode='raise' it lets take write straight into out without buffering
+        lut.take(neighborhood, out=out[t+1], mode='clip')
+
+
+def numpy_batch_evolve_into(out, luts, rules, nthreads=None):
+    '''
+    Pure-NumPy counterpart of numba_kernels.batch_evolve_into, evolving the CAs of the batch
+    one after another. nthreads is accepted for compatibility and ignored.
+    '''
+    for b in range(out.shape[0]):
+        numpy_evolve_into(out[b], luts[rules[b]])
+
+
+if evolve_into is None:
+    evolve_into, batch_evolve_into = numpy_evolve_into, numpy_batch_evolve_into
 
 
 # In[6]:
@@ -153,6 +265,12 @@ def three_state_spacetime_field(rule_number, initial_condition, time_steps):
         should be ints. 
     time_steps: int
         Positive integer specifying the number of time steps for evolving the ECA. 
+        
+    Returns
+    -------
+    spacetime_field: ndarray
+        2D uint8 array of shape (time_steps+1, len(initial_condition)); spacetime_field[t] is the
+        spatial configuration at time t.
     '''
     if time_steps < 0:
         raise ValueError("time_steps must be a non-negative integer")
@@ -162,38 +280,153 @@ def three_state_spacetime_field(rule_number, initial_condition, time_steps):
     except ValueError:
         raise ValueError("time_steps must be a non-negative integer")
         
-    # we will see a cleaner and more efficient way to do the following when we introduce numpy
-    for i in initial_condition:
-        if i not in [0,1,2]:
-            raise ValueError("initial condition must be a list of 0s, 1s and 2s")
-        
-    lookup = three_state_lookup_table(rule_number)
-    length = len(initial_condition)
+    current_configuration = _validate_ic(initial_condition)
+    lut = three_state_lookup_array(rule_number)
+    length = len(current_configuration)
     
-    # initialize spacetime field and current configuration
-    spacetime_field = [initial_condition]
-    current_configuration = initial_condition.copy()
+    # preallocate the spacetime field and store the initial condition as its first row
+    spacetime_field = np.empty((time_steps+1, length), dtype=np.uint8)
+    spacetime_field[0] = current_configuration
 
     # apply the lookup table to evolve the CA for the given number of time steps
-    for t in range(time_steps):
-        new_configuration = []
-        for i in range(length):
+    numpy_evolve_into(spacetime_field, lut)
+    
+    return spacetime_field
+
 
-            neighborhood = (current_configuration[(i-1)], 
-                            current_configuration[i])
+# In[ ]:
 
-            new_configuration.append(lookup[neighborhood])
 
-        current_configuration = new_configuration
-        spacetime_field.append(new_configuration)
+def batch_evolve(rule_numbers, initial_conditions, time_steps, nthreads=None):
+    '''
+    Evolves many three-state CAs at once, each with its own rule number and initial condition,
+    splitting the batch across threads.
     
-    return spacetime_field
+    Parameters
+    ----------
+    rule_numbers: array_like
+        Length-B sequence of ints between 0 and 19682, inclusive. rule_numbers[b] specifies
+        the lookup table of CA b according to the Wolfram numbering scheme.
+    initial_conditions: array_like
+        2D array of shape (B, N) of 0s, 1s and 2s; initial_conditions[b] is the initial
+        condition of CA b. An empty list is taken as a batch of shape (0, 0); pass an empty
+        array of shape (0, N) to get an empty result with lattice length N.
+    time_steps: int
+        Positive integer specifying the number of time steps for evolving the CAs.
+    nthreads: int, optional (default=None)
+        Number of threads to use. If None, Numba's current setting is used. Ignored when
+        Numba isn't available.
+        
+    Returns
+    -------
+    spacetime_fields: ndarray
+        3D uint8 array of shape (B, time_steps+1, N); spacetime_fields[b] is the spacetime
+        field of CA b.
+    '''
+    if time_steps < 0:
+        raise ValueError("time_steps must be a non-negative integer")
+    # try converting time_steps to int and raise a custom error if this can't be done
+    try:
+        time_steps = int(time_steps)
+    except ValueError:
+        raise ValueError("time_steps must be a non-negative integer")
+    
+    rule_numbers = np.asarray(rule_numbers)
+    if rule_numbers.size == 0:
+        # an empty list comes out as float64, but is a valid (empty) batch
+        rule_numbers = rule_numbers.astype(np.int64)
+    if (rule_numbers.ndim != 1 or not np.issubdtype(rule_numbers.dtype, np.integer)
+            or (rule_numbers < 0).any() or (rule_numbers > 19682).any()):
+        raise ValueError("rule_numbers must be a list of ints between 0 and 19682, inclusive")
+    initial_conditions = _validate_ic(initial_conditions, ndim=2)
+    if initial_conditions.shape[0] != rule_numbers.shape[0]:
+        raise ValueError("initial_conditions must be a 2D array with one row per rule number")
+    
+    B, length = initial_conditions.shape
+    spacetime_fields = np.empty((B, time_steps+1, length), dtype=np.uint8)
+    spacetime_fields[:, 0] = initial_conditions
+    batch_evolve_into(spacetime_fields, all_lookup_arrays(), rule_numbers, nthreads)
+    return spacetime_fields
 
 
 # In[7]:
 
 
-def spacetime_diagram(spacetime_field, size=12, colors=plt.cm.Greys):
+class Renderer(object):
+    '''
+    Renders spacetime diagrams to image files on a background thread, so that simulations
+    don't have to wait on matplotlib.
+    '''
+    def __init__(self):
+        '''
+        Starts the daemon render thread, which takes diagrams off a queue in submission order.
+        Since the thread is a daemon, call join before exiting to make sure everything queued
+        has been saved.
+        '''
+        self._queue = queue.Queue()
+        self._errors = []
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, spacetime_field, size, colors, filename):
+        '''
+        Queues a spacetime diagram to be saved to filename. spacetime_field is rendered as is,
+        so callers should pass a copy if they will keep modifying it.
+        '''
+        self._queue.put((spacetime_field, size, colors, filename))
+
+    def join(self):
+        '''
+        Blocks until every submitted diagram has been handled. If any of them failed to render
+        or save since the last call, the first such exception is re-raised here.
+        '''
+        self._queue.join()
+        with self._lock:
+            errors, self._errors = self._errors, []
+        if errors:
+            raise errors[0]
+
+    def _run(self):
+        while True:
+            spacetime_field, size, colors, filename = self._queue.get()
+            try:
+                # use a standalone Figure rather than pyplot, which is not thread safe
+                fig = Figure(figsize=(size,size))
+                ax = fig.subplots()
+                ax.imshow(spacetime_field, cmap=colors, interpolation='nearest')
+                fig.savefig(filename)
+            except Exception as error:
+                with self._lock:
+                    self._errors.append(error)
+            finally:
+                self._queue.task_done()
+
+
+_renderer = None
+
+def _get_renderer():
+    global _renderer
+    if _renderer is None:
+        _renderer = Renderer()
+    return _renderer
+
+
+def wait_for_renders():
+    '''
+    Blocks until every diagram queued with spacetime_diagram(..., async_=True) has been saved,
+    re-raising the first render or save failure, if any. This also runs automatically at exit.
+    '''
+    if _renderer is not None:
+        _renderer.join()
+
+atexit.register(wait_for_renders)
+
+
+# In[ ]:
+
+
+def spacetime_diagram(spacetime_field, size=12, colors=plt.cm.Greys, async_=False, filename=None):
     '''
     Produces a simple spacetime diagram image using matplotlib imshow with 'nearest' interpolation.
     
@@ -208,12 +441,63 @@ def spacetime_diagram(spacetime_field, size=12, colors=plt.cm.Greys):
     colors: matplotlib colormap, optional (default=plt.cm.Greys)
         See https://matplotlib.org/tutorials/colors/colormaps.html for colormap choices.
         A colormap 'cmap' is called as: colors=plt.cm.cmap
+    async_: bool, optional (default=False)
+        If True, a copy of the spacetime field is queued to a background render thread and the
+        function returns immediately; the diagram is saved to filename instead of being shown.
+        Call wait_for_renders() to block until queued diagrams are saved and to find out about
+        failures; it is also called automatically when the interpreter exits.
+    filename: str, optional (default=None)
+        Image file the diagram is saved to. Required when async_ is True.
     '''
+    if async_:
+        if filename is None:
+            raise ValueError("filename must be given when async_ is True")
+        _get_renderer().submit(np.array(spacetime_field, copy=True), size, colors, filename)
+        return
     plt.figure(figsize=(size,size))
     plt.imshow(spacetime_field, cmap=colors, interpolation='nearest')
     plt.show()
 
 
+# In[ ]:
+
+
+def pack_ternary(configurations):
+    '''
+    Packs ternary configurations at 2 bits per cell, 4 cells per byte.
+    
+    Parameters
+    ----------
+    configurations: ndarray
+        uint8 array of 0s, 1s and 2s; the last axis is the spatial axis, of length N.
+        
+    Returns
+    -------
+    packed: ndarray
+        uint8 array with the same leading axes and a last axis of length ceil(N/4). Cell 4*j + k
+        is stored in bits 2*k and 2*k + 1 of byte j.
+    '''
+    N = configurations.shape[-1]
+    padded = np.zeros(configurations.shape[:-1] + (-(-N // 4) * 4,), dtype=np.uint8)
+    padded[..., :N] = configurations
+    cells = padded.reshape(configurations.shape[:-1] + (-1, 4))
+    return cells[..., 0] | (cells[..., 1] << 2) | (cells[..., 2] << 4) | (cells[..., 3] << 6)
+
+
+def unpack_ternary(packed, length):
+    '''
+    Inverse of pack_ternary: unpacks configurations of the given length from 2 bits per cell
+    back to one uint8 per cell.
+    '''
+    shifts = np.array([0, 2, 4, 6], dtype=np.uint8)
+    cells = (packed[..., np.newaxis] >> shifts) & 3
+    return cells.reshape(packed.shape[:-1] + (-1,))[..., :length]
+
+
+# number of cells evolved at a time before packing, for CAs that store a packed spacetime field
+_PACKED_CHUNK_CELLS = 1 << 22
+
+
 # In[8]:
 
 
@@ -221,7 +505,7 @@ class three_state_CA(object):
     '''
     Three-state cellular automata simulator.
     '''
-    def __init__(self, rule_number, initial_condition):
+    def __init__(self, rule_number, initial_condition, packed=False):
         '''
         Initializes the simulator for the given rule number and initial condition.
         
@@ -233,6 +517,9 @@ class three_state_CA(object):
         initial_condition: list
             Ternary string used as the initial condition for the three-state CA. Elements of the list
             should be ints. 
+        packed: bool, optional (default=False)
+            If True, the spacetime field is stored at 2 bits per cell (see pack_ternary) instead
+            of one byte per cell, cutting its memory use by 4x for long runs.
         
         Attributes
         ----------
@@ -240,23 +527,60 @@ class three_state_CA(object):
             Lookup table for the three-state CA given as a dictionary, with neighborhood tuple keys. 
         initial: array_like
             Copy of the initial conditions used to instantiate the simulator
-        spacetime: array_like
-            2D array (list of lists) of the spacetime field created by the simulator.
-        current_configuration: array_like
-            List of the spatial configuration of the ECA at the current time
+        spacetime: ndarray
+            2D uint8 array of the spacetime field created by the simulator. This is a view of
+            the first time+1 rows of a preallocated buffer that grows as the CA is evolved.
+            If packed is True, it is instead unpacked into a new array on each access; use
+            get_row to look at single time steps.
+        current_configuration: ndarray
+            uint8 array of the spatial configuration of the ECA at the current time
+        packed: bool
+            Whether the spacetime field is stored at 2 bits per cell.
         '''
-        # we will see a cleaner and more efficient way to do the following when we introduce numpy
-        for i in initial_condition:
-            if i not in [0,1,2]:
-                raise ValueError("initial condition must be a list of 0s, 1s, and 2s")
-                
+        self.current_configuration = _validate_ic(initial_condition)
         self.lookup_table = three_state_lookup_table(rule_number)
+        self._lut = three_state_lookup_array(rule_number)
         self.initial = initial_condition
-        self.spacetime = [initial_condition]
-        self.current_configuration = initial_condition.copy()
-        self._length = len(initial_condition)
+        self._length = len(self.current_configuration)
+        self.packed = packed
+        # spacetime buffer, of which the rows 0 to self._t are filled in
+        if packed:
+            self._spacetime = pack_ternary(self.current_configuration)[np.newaxis, :]
+        else:
+            self._spacetime = self.current_configuration[np.newaxis, :].copy()
+        self._t = 0
+
+    @property
+    def spacetime(self):
+        if self.packed:
+            return unpack_ternary(self._spacetime[:self._t+1], self._length)
+        return self._spacetime[:self._t+1]
+
+    def get_row(self, t):
+        '''
+        Returns a copy of the spatial configuration at time t, between 0 and the current time
+        inclusive, as a uint8 array.
+        '''
+        if t < 0 or t > self._t:
+            raise IndexError("t must be between 0 and the current time, inclusive")
+        if self.packed:
+            return unpack_ternary(self._spacetime[t], self._length)
+        return self._spacetime[t].copy()
 
-    def evolve(self, time_steps):
+    def _reserve(self, time_steps):
+        '''
+        Grows the spacetime buffer, if needed, so that it can hold time_steps more rows.
+        Capacity at least doubles on each reallocation so repeated calls to evolve stay cheap.
+        '''
+        needed = self._t + time_steps + 1
+        capacity = self._spacetime.shape[0]
+        if needed <= capacity:
+            return
+        spacetime = np.empty((max(needed, 2*capacity), self._spacetime.shape[1]), dtype=np.uint8)
+        spacetime[:self._t+1] = self._spacetime[:self._t+1]
+        self._spacetime = spacetime
+
+    def evolve(self, time_steps, nthreads=None):
         '''
         Evolves the current configuration of the three-state CA for the given number of time steps.
         
@@ -264,6 +588,9 @@ class three_state_CA(object):
         ----------
         time_steps: int
             Positive integer specifying the number of time steps for evolving the three-state CA.  
+        nthreads: int, optional (default=None)
+            Number of threads used when the lattice is large enough to be evolved in parallel.
+            If None, Numba's current setting is used. Ignored when Numba isn't available.
         '''
         if time_steps < 0:
             raise ValueError("time_steps must be a non-negative integer")
@@ -273,17 +600,26 @@ class three_state_CA(object):
         except ValueError:
             raise ValueError("time_steps must be a non-negative integer")
 
-        for _ in range(time_steps): # use underscore if the index will not be used
-            new_configuration = []
-            for i in range(self._length):
-
-                neighborhood = (self.current_configuration[(i-1)], 
-                                self.current_configuration[i])
-
-                new_configuration.append(self.lookup_table[neighborhood])
-
-            self.current_configuration = new_configuration
-            self.spacetime.append(new_configuration)
+        self._reserve(time_steps)
+        if not self.packed:
+            evolve_into(self._spacetime[self._t:self._t+time_steps+1], self._lut, nthreads)
+            self._t += time_steps
+            self.current_configuration = self._spacetime[self._t].copy()
+            return
+
+        # evolve unpacked rows a chunk at a time, packing each chunk into the spacetime buffer
+        chunk = max(1, min(time_steps, _PACKED_CHUNK_CELLS // max(self._length, 1)))
+        work = np.empty((chunk+1, self._length), dtype=np.uint8)
+        work[0] = unpack_ternary(self._spacetime[self._t], self._length)
+        remaining = time_steps
+        while remaining > 0:
+            steps = min(chunk, remaining)
+            evolve_into(work[:steps+1], self._lut, nthreads)
+            self._spacetime[self._t+1:self._t+steps+1] = pack_ternary(work[1:steps+1])
+            self._t += steps
+            remaining -= steps
+            work[0] = work[steps]
+        self.current_configuration = work[0].copy()
 
 
 # In[9]:
@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Ahead-of-time compilation of the serial evolution kernel
+
+# Running this script builds the ca_kernels extension module next to numba_kernels.py.
+# numba_kernels uses it in place of the JIT-compiled _evolve when it is importable, so small
+# runs like the demo don't pay the JIT compile cost on first use:
+#
+#     python build_aot.py
+#
+# The compiled module is not rebuilt or checked for staleness automatically: re-run this
+# script after any change to numba_kernels._evolve.
+
+import os
+
+from numba import types
+from numba.pycc import CC
+
+import numba_kernels
+
+cc = CC('ca_kernels')
+cc.output_dir = os.path.dirname(os.path.abspath(__file__))
+
+# the spacetime buffer is written in place, while the lookup table may be a read-only view
+# of all_lookup_arrays()
+signature = types.void(types.uint8[:, ::1], types.Array(types.uint8, 1, 'C', readonly=True))
+cc.export('evolve', signature)(numba_kernels._evolve.py_func)
+
+
+if __name__ == '__main__':
+    cc.compile()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Numba kernels for evolving the 3-state cellular automata
+
+# Neighborhoods are packed as 3*a + b, where a is the state of the cell above and to the left
+# and b is the state of the cell directly above, so the lookup table is a flat length-9 array.
+#
+# The kernels evolve a preallocated spacetime array in place: out[0] holds the starting
+# configuration and each following row is computed from the one before it.
+
+import numba
+import numpy as np
+from numba import njit, prange
+
+# number of cell updates (length * time steps) above which the parallel kernel is used;
+# below this the thread start-up overhead outweighs the work done per time step
+PARALLEL_THRESHOLD = 1 << 20
+
+
+@njit(cache=True)
+def _evolve(out, lut):
+    '''
+    Fills rows 1, 2, ... of out by evolving out[0] with the flat lookup table.
+    
+    Parameters
+    ----------
+    out: ndarray
+        2D uint8 array of shape (T+1, N). out[0] is the starting configuration of 0s, 1s and 2s.
+    lut: ndarray
+        Length-9 uint8 lookup table indexed by the packed neighborhood 3*a + b.
+    '''
+    T = out.shape[0] - 1
+    N = out.shape[1]
+    if N == 0:
+        return
+    for t in range(T):
+        prev = out[t]
+        # carry the left neighbor in a scalar, starting from the periodic wrap-around cell
+        left = prev[N-1]
+        for i in range(N):
+            out[t+1, i] = lut[left*3 + prev[i]]
+            left = prev[i]
+
+
+try:
+    # ahead-of-time compiled copy of _evolve, built by build_aot.py. It is not rebuilt
+    # automatically, so build_aot.py must be re-run whenever _evolve is changed.
+    from ca_kernels import evolve as _evolve_aot
+except ImportError:
+    _evolve_aot = None
+
+
+def _evolve_serial(out, lut):
+    '''
+    Runs the ahead-of-time compiled _evolve if it is available and the arrays match its
+    exported signature, and the JIT-compiled _evolve otherwise. The compiled module does no
+    type or layout checking of its own, so anything else must not be passed to it.
+    '''
+    if (_evolve_aot is not None
+            and out.dtype == np.uint8 and out.ndim == 2
+            and out.flags.c_contiguous and out.flags.writeable
+            and lut.dtype == np.uint8 and lut.ndim == 1 and lut.flags.c_contiguous):
+        _evolve_aot(out, lut)
+    else:
+        _evolve(out, lut)
+
+
+@njit(parallel=True, cache=True, boundscheck=False)
+def _evolve_parallel(out, lut):
+    '''
+    Same as _evolve, but updates the cells of each time step in parallel. The time loop stays
+    serial since each row depends on the previous one.
+    '''
+    T = out.shape[0] - 1
+    N = out.shape[1]
+    if N == 0:
+        return
+    for t in range(T):
+        prev = out[t]
+        for i in prange(N):
+            # prange iterations can't carry the left neighbor, so wrap around explicitly
+            left = prev[i-1] if i > 0 else prev[N-1]
+            out[t+1, i] = lut[left*3 + prev[i]]
+
+
+@njit(parallel=True, cache=True)
+def _batch_evolve(out, luts, rules):
+    '''
+    Evolves a batch of independent CAs in parallel, one per thread. out has shape (B, T+1, N),
+    with out[b, 0] the initial condition of CA b, which is evolved with luts[rules[b]].
+    '''
+    for b in prange(out.shape[0]):
+        _evolve(out[b], luts[rules[b]])
+
+
+def evolve_into(out, lut, nthreads=None):
+    '''
+    Evolves out[0] in place to fill the remaining rows of out, picking the serial or parallel
+    kernel based on the amount of work.
+    
+    Parameters
+    ----------
+    out: ndarray
+        C-contiguous 2D uint8 array of shape (T+1, N). out[0] is the starting configuration.
+    lut: ndarray
+        Length-9 uint8 lookup table indexed by the packed neighborhood 3*a + b.
+    nthreads: int, optional (default=None)
+        Number of threads used by the parallel kernel. If None, Numba's current setting is used.
+    '''
+    if (out.shape[0] - 1) * out.shape[1] < PARALLEL_THRESHOLD:
+        _evolve_serial(out, lut)
+        return
+    if nthreads is None:
+        _evolve_parallel(out, lut)
+        return
+    # restore the caller's thread count afterwards so later calls with nthreads=None aren't affected
+    previous = numba.get_num_threads()
+    numba.set_num_threads(nthreads)
+    try:
+        _evolve_parallel(out, lut)
+    finally:
+        numba.set_num_threads(previous)
+
+
+def evolve_kernel(initial, lut, T, nthreads=None):
+    '''
+    Evolves the given initial condition for T time steps.
+    
+    Parameters
+    ----------
+    initial: ndarray
+        uint8 array of 0s, 1s and 2s used as the initial condition.
+    lut: ndarray
+        Length-9 uint8 lookup table indexed by the packed neighborhood 3*a + b.
+    T: int
+        Non-negative number of time steps.
+    nthreads: int, optional (default=None)
+        Number of threads used by the parallel kernel. If None, Numba's current setting is used.
+        
+    Returns
+    -------
+    out: ndarray
+        2D uint8 array of shape (T+1, len(initial)); out[0] is the initial condition.
+    '''
+    out = np.empty((T+1, initial.shape[0]), dtype=np.uint8)
+    out[0] = initial
+    evolve_into(out, lut, nthreads)
+    return out
+
+
+def batch_evolve_into(out, luts, rules, nthreads=None):
+    '''
+    Evolves a batch of CAs in place, with the batch axis split across threads.
+    
+    Parameters
+    ----------
+    out: ndarray
+        C-contiguous 3D uint8 array of shape (B, T+1, N). out[b, 0] is the starting
+        configuration of CA b.
+    luts: ndarray
+        2D uint8 array of flat lookup tables, one per row.
+    rules: ndarray
+        Length-B integer array; CA b is evolved with luts[rules[b]].
+    nthreads: int, optional (default=None)
+        Number of threads to use. If None, Numba's current setting is used.
+    '''
+    if nthreads is None:
+        _batch_evolve(out, luts, rules)
+        return
+    # restore the caller's thread count afterwards, as in evolve_into
+    previous = numba.get_num_threads()
+    numba.set_num_threads(nthreads)
+    try:
+        _batch_evolve(out, luts, rules)
+    finally:
+        numba.set_num_threads(previous)